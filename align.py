@@ -122,3 +122,5 @@ if __name__ == "__main__":
         print("Fail {} deleting {}".format(e, to_path))
         shutil.rmtree(to_path)
         pass
+    # images may have been overwritten in place, invalidate dataset caches
+    os.utime(target_path)
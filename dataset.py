@@ -1,17 +1,26 @@
 import os
 import torch
 import numpy as np
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, DataLoader, \
+                             get_worker_info
 import torchvision.transforms as T
-from utils import DATA_DIR, ALIGNED_DATA_DIR, get_data_path, mkdir, lsdir
-from pdb import set_trace
-from align import align
-from matplotlib import pyplot as plt
+from utils import DATA_DIR, ALIGNED_DATA_DIR, mkdir, lsdir
+import threading
 import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import torchvision.transforms.functional as tF
 from torch.utils.data.dataloader import default_collate
 from PIL import Image
 
+# per-channel (R, G, B) averages of the per-image means and stds of ./data,
+# from an earlier per-image version of get_mean_std(). A mean of per-image
+# stds leaves out the variation between images, so STD is smaller than the
+# pixel-weighted std get_mean_std() returns now, rerun it to refresh these.
+MEAN = (0.6118626050840847, 0.4627732225147951, 0.39181750819165523)
+STD = (0.24004882860157573, 0.20515205679125115, 0.19287499225344598)
+
 class FaceScrubDataset(Dataset):
     '''
     The dataset has a total of 63903 images of 530 faces. The most images a person has is 191, and the least images a person has is 39.
@@ -30,6 +39,13 @@ class FaceScrubDataset(Dataset):
 
     Five images per person set aside for test,
         7,022,500
+
+    Shuffling that many indices is impractical, wrap the dataset in
+    FaceScrubPairs to sample pairs for training instead.
+
+    self.labels is an int64 array parallel to self.img_paths, holding the index
+    into self.names of the person in each image. Labels are only ever read from
+    it, never parsed back out of the paths.
     '''
     def __init__(self, **kwargs):
         hash_dim = kwargs.get("hash_dim", 48)
@@ -37,20 +53,92 @@ class FaceScrubDataset(Dataset):
         mode = kwargs.get("mode", "train")
         transform = kwargs.get("transform", [])
         normalize = kwargs.get("normalize", False)
-        align = kwargs.get("align", False)
-
+        use_align = kwargs.get("use_align", False)
+        # comparison pairs reuse each image ~n times, labels read it once
+        cache_size = kwargs.get("cache_size",
+                                4096 if type == "comparison" else 0)
+        # directory for the cache of the image paths, and of the images
+        # resized to img_size x img_size if img_size is set
+        cache_dir = kwargs.get("cache_dir", None)
+        img_size = kwargs.get("img_size", None)
+        # return the undecoded JPEG bytes, for decode_batch() on the GPU
+        raw = kwargs.get("raw", False)
+
+        if "align" in kwargs:
+            raise Exception("align was renamed to use_align")
         if mode not in ["train", "val", "test"]:
             raise Exception("Invalid dataset mode")
         if type not in ["label", "comparison"]:
             raise Exception("Invalid dataset type")
+        if img_size is not None and cache_dir is None:
+            raise Exception("img_size requires cache_dir")
+        # the image cache replaces the transformations, it can't apply them
+        if img_size is not None and transform:
+            raise Exception("img_size can't be combined with transform")
 
-        self.data_dir = ALIGNED_DATA_DIR if align else DATA_DIR
+        self.data_dir = ALIGNED_DATA_DIR if use_align else DATA_DIR
         self.mode = mode
         self.type = type
-        self.names = lsdir(self.data_dir)
-        self.img_paths = self._get_all_img_paths()
+        self.raw = raw
         self.hash_dim = hash_dim
         self.transform = T.Compose(transform)
+        self._img_cache = OrderedDict()
+        self._img_cache_max = cache_size
+        self._img_cache_lock = threading.Lock()
+        self._mm, self._mm_ok, self._mm_path = None, None, None
+
+        if cache_dir is None:
+            self.names = lsdir(self.data_dir)
+            self.img_paths, self.labels = self._get_all_img_paths()
+            return
+
+        mkdir(cache_dir)
+        cache_path = "{}/{}{}".format(cache_dir,
+                                      "aligned_" if use_align else "", mode)
+        paths_path = cache_path + "_paths.npz"
+        data_mtime = self._get_data_mtime()
+        if self._is_cache_fresh(paths_path, data_mtime):
+            cache = np.load(paths_path)
+            self.names = cache["names"].tolist()
+            self.img_paths = cache["paths"].tolist()
+            self.labels = cache["labels"]
+        else:
+            self.names = lsdir(self.data_dir)
+            self.img_paths, self.labels = self._get_all_img_paths()
+            tmp_path = cache_path + "_paths.tmp.npz"
+            np.savez(tmp_path, names=np.array(self.names),
+                     paths=np.array(self.img_paths), labels=self.labels)
+            os.replace(tmp_path, paths_path)
+        if raw or img_size is None:
+            return
+        self._mm, self._mm_ok = self._load_mm_cache(
+            "{}_{}".format(cache_path, img_size), img_size, data_mtime)
+        self._mm_path = "{}_{}.npy".format(cache_path, img_size)
+
+    def __getstate__(self):
+        # DataLoader workers started with spawn get a pickled copy, which
+        # can't hold the lock and would copy the memory map into each worker
+        state = self.__dict__.copy()
+        state["_img_cache"] = OrderedDict()
+        state["_img_cache_lock"] = None
+        state["_mm"] = None
+        return state
+
+    def __setstate__(self, state):
+        # instances pickled before these attributes existed, such as the ones
+        # in ./dataset.pickle, get their defaults
+        state.setdefault("raw", False)
+        state.setdefault("_img_cache_max", 0)
+        state.setdefault("_mm_ok", None)
+        state.setdefault("_mm_path", None)
+        self.__dict__.update(state)
+        if "labels" not in state:
+            self.labels = self._get_labels_from_paths()
+        self._img_cache = OrderedDict()
+        self._img_cache_lock = threading.Lock()
+        self._mm = None
+        if self._mm_path is not None:
+            self._mm = np.load(self._mm_path, mmap_mode="r")
 
     def __len__(self):
         if self.type == "comparison":
@@ -69,6 +157,28 @@ class FaceScrubDataset(Dataset):
         else:
             raise Exception("Invalid dataset type")
 
+    def __getitems__(self, indices):
+        '''
+        Batched __getitem__(), called by the DataLoader with the indices of a
+        whole batch. Images that can't be read give None datapoints, which
+        invalid_collate() drops.
+        '''
+        if self.type == "comparison":
+            pairs = [self._get_pair_from_index(index) for index in indices]
+            xs, ys = [x for x, _ in pairs], [y for _, y in pairs]
+            bimgs, cimgs = self._get_imgs(xs), self._get_imgs(ys)
+            labels = (self.labels[xs] == self.labels[ys]).tolist()
+            return [None if bimg is None or cimg is None
+                    else (bimg, cimg, int(label))
+                    for bimg, cimg, label in zip(bimgs, cimgs, labels)]
+        elif self.type == "label":
+            imgs = self._get_imgs(indices)
+            labels = self.labels[indices].tolist()
+            return [None if img is None else (img, label)
+                    for img, label in zip(imgs, labels)]
+        else:
+            raise Exception("Invalid dataset type")
+
     def _get_data_comparison(self, index):
         '''
         For __getitem__() method. Return data at index in the format,
@@ -76,10 +186,10 @@ class FaceScrubDataset(Dataset):
 
         Label is an integer specifying whether the baseline and comparison are of the same person. 1 is True and 0 is False.
         '''
-        baseline, compare = self._get_pair_from_index(index)
-        label = baseline.split("/")[2] == compare.split("/")[2]
-        bimg = self._get_img_from_path(baseline)
-        cimg = self._get_img_from_path(compare)
+        x, y = self._get_pair_from_index(index)
+        label = self.labels[x] == self.labels[y]
+        bimg = self._get_img(x)
+        cimg = self._get_img(y)
         return (bimg, cimg, int(label))
 
     def _get_data_label(self, index):
@@ -90,10 +200,8 @@ class FaceScrubDataset(Dataset):
         hash_code is a numpy array of integers of 0s and 1s, mapping the name
         of the peson into Hamming space.
         '''
-        img_path = self.img_paths[index]
-        name = img_path.split("/")[2]
         try:
-            output = self._get_img_from_path(img_path), self.names.index(name)
+            output = self._get_img(index), int(self.labels[index])
         except Exception as error:
             # print("Exception countered ({}): {}".format(index, error))
             output = None
@@ -102,24 +210,39 @@ class FaceScrubDataset(Dataset):
 
     def _get_pair_from_index(self, index):
         '''
-        Return the paths to a pair of images based on the index.
+        Return the indices of a pair of images based on the index.
         '''
         num_imgs = len(self.img_paths)
-        x, y = index % num_imgs, index // num_imgs
-        return self.img_paths[x], self.img_paths[y]
+        return index % num_imgs, index // num_imgs
 
     def _get_folder_paths(self):
         '''
         Return a list of folder paths for all of the people.
         '''
-        return list(map(lambda name: self.data_dir + "/" + name, self.names))
+        return [self.data_dir + "/" + name for name in self.names]
 
     def _get_all_img_paths(self):
         '''
-        Return a list of all image paths.
+        Return a list of all image paths, and a parallel array of label indices
+        into self.names.
+        '''
+        # listing directories is I/O bound, so threads overlap the syscalls
+        num_workers = min(32, 4 * multiprocessing.cpu_count())
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            paths = list(executor.map(self._get_img_paths, self.names))
+        counts = np.array([len(p) for p in paths], dtype=np.int64)
+        labels = np.repeat(np.arange(len(paths), dtype=np.int64), counts)
+        return [path for person in paths for path in person], labels
+
+    def _get_labels_from_paths(self):
         '''
-        paths = list(map(self._get_img_paths, self.names))
-        return sum(paths, [])
+        Returns the label array for self.img_paths, by reading each person's
+        name out of the path. Only used for instances pickled without labels.
+        '''
+        name_to_idx = {name: i for i, name in enumerate(self.names)}
+        start = len(self.data_dir) + 1
+        return np.array([name_to_idx[path[start:].split("/", 1)[0]]
+                         for path in self.img_paths], dtype=np.int64)
 
     def _get_img_paths(self, name):
         '''
@@ -136,22 +259,316 @@ class FaceScrubDataset(Dataset):
         else:
             raise Exception("Invalid dataset mode")
 
-        files = list(filter(lambda f: f not in ["val", "test"], lsdir(folder)))
-        return list(map(lambda fp: folder + "/" + fp, files))
+        prefix = folder + "/"
+        return [prefix + f for f in lsdir(folder) if f not in ("val", "test")]
+
+    def _get_data_mtime(self):
+        '''
+        Returns the latest modification time of the data directory and of the
+        folders holding this mode's images, <name> for train and <name>/<mode>
+        otherwise, which changes whenever images are added, removed or moved.
+        Writers that overwrite images in place, like align.py, touch the data
+        directory instead.
+
+        This costs one listing of the data directory and one stat per person,
+        so a cache hit saves listing every person's folder and building the
+        path list from the ~64k file names.
+        '''
+        suffix = "" if self.mode == "train" else "/" + self.mode
+        mtime = os.stat(self.data_dir).st_mtime
+        for name in lsdir(self.data_dir):
+            try:
+                mtime = max(mtime, os.stat(
+                    self.data_dir + "/" + name + suffix).st_mtime)
+            except FileNotFoundError:
+                # a folder created later is newer than any cache
+                pass
+        return mtime
+
+    def _is_cache_fresh(self, path, data_mtime):
+        '''
+        Returns whether the cache file at path was written after data_mtime,
+        from self._get_data_mtime().
+        '''
+        return os.path.exists(path) and os.path.getmtime(path) > data_mtime
+
+    def _load_mm_cache(self, cache_path, img_size, data_mtime):
+        '''
+        Returns a read-only memory map of all of the images resized to
+        3 x img_size x img_size uint8 arrays, and a boolean array of which
+        images could be read. Both are built at cache_path on the first run,
+        and rebuilt when older than data_mtime.
+        '''
+        imgs_path, ok_path = cache_path + ".npy", cache_path + "_ok.npy"
+        shape = (len(self.img_paths), 3, img_size, img_size)
+
+        if self._is_cache_fresh(imgs_path, data_mtime) and \
+                self._is_cache_fresh(ok_path, data_mtime):
+            mm, ok = np.load(imgs_path, mmap_mode="r"), np.load(ok_path)
+            if mm.shape == shape and ok.shape == shape[:1]:
+                return mm, ok
+
+        print("Building image cache at {}".format(imgs_path))
+        # write to a temporary file so an interrupted build is never loaded
+        tmp_path = cache_path + ".tmp.npy"
+        mm = np.lib.format.open_memmap(tmp_path, mode="w+",
+                                       dtype=np.uint8, shape=shape)
+        ok = np.zeros(len(self.img_paths), dtype=bool)
+        load = partial(load_resized_img, img_size=img_size)
+        with multiprocessing.Pool(max(1, multiprocessing.cpu_count()-2)) as pool:
+            imgs = pool.imap(load, self.img_paths, chunksize=256)
+            for i, img in enumerate(imgs):
+                if img is not None:
+                    mm[i], ok[i] = img, True
+        mm.flush()
+        del mm
+        # the mask goes in first, so the images file never pairs with an
+        # older mask
+        tmp_ok_path = cache_path + "_ok.tmp.npy"
+        np.save(tmp_ok_path, ok)
+        os.replace(tmp_ok_path, ok_path)
+        os.replace(tmp_path, imgs_path)
+        return np.load(imgs_path, mmap_mode="r"), ok
+
+    def _get_img(self, index):
+        '''
+        Returns the image at index, from the memory-mapped cache if one is
+        configured, or as a uint8 tensor of the JPEG file's bytes if self.raw.
+        '''
+        if self.raw:
+            # imported here so raw=False works with older torchvision
+            from torchvision.io import read_file
+            return read_file(self.img_paths[index])
+        if self._mm is None:
+            return self._get_img_from_path(self.img_paths[index])
+        if not self._mm_ok[index]:
+            raise Exception("Invalid image: " + self.img_paths[index])
+        return torch.from_numpy(np.array(self._mm[index]))
+
+    def _get_imgs(self, indices):
+        '''
+        Returns a list of the images at indices, with None for the images that
+        can't be read. The memory-mapped cache is read in one slice, otherwise
+        the images are decoded on a thread pool.
+        '''
+        if self._mm is not None:
+            imgs = torch.from_numpy(np.asarray(self._mm[indices]))
+            return [img if ok else None
+                    for img, ok in zip(imgs, self._mm_ok[indices])]
+
+        def load(index):
+            try:
+                return self._get_img(index)
+            except Exception:
+                return None
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            return list(executor.map(load, indices))
 
     def _get_img_from_path(self, path):
         '''
         Returns an image and applies the transformations defined in self.transform.
+
+        The last self._img_cache_max transformed images are kept in an LRU
+        cache, so the transformations must be deterministic when it is enabled.
         '''
-        img = Image.open(path)
+        if self._img_cache_max > 0:
+            with self._img_cache_lock:
+                if path in self._img_cache:
+                    self._img_cache.move_to_end(path)
+                    return self._img_cache[path]
+
+        img = Image.open(path).convert("RGB")
         if self.transform is not None:
             img = self.transform(img)
+
+        if self._img_cache_max > 0:
+            with self._img_cache_lock:
+                self._img_cache[path] = img
+                if len(self._img_cache) > self._img_cache_max:
+                    self._img_cache.popitem(last=False)
         return img
 
+class FaceScrubShuffler(IterableDataset):
+    '''
+    Iterates over a "label" FaceScrubDataset in random order while reading the
+    images sequentially. The dataset is split into chunks of consecutive
+    images, the chunks are visited in random order, and each chunk is loaded
+    into a buffer and yielded shuffled.
+
+    shuffle_size is the total number of buffered images, split evenly between
+    the DataLoader workers.
+    '''
+    def __init__(self, dataset, **kwargs):
+        shuffle_size = kwargs.get("shuffle_size", 32768)
+
+        if dataset.type != "label":
+            raise Exception("Invalid dataset type")
+
+        self.dataset = dataset
+        self.shuffle_size = shuffle_size
+        # persistent workers keep their seed, so it's mixed with the epoch
+        self._epoch = 0
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+            seed = int(torch.empty((), dtype=torch.int64).random_())
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+            # the base seed is shared, so every worker agrees on chunk order
+            seed = worker_info.seed - worker_info.id
+        # every worker's copy counts epochs in step
+        seed += self._epoch
+        self._epoch += 1
+
+        num_imgs = len(self.dataset)
+        chunk_size = max(1, self.shuffle_size // num_workers)
+        starts = list(range(0, num_imgs, chunk_size))
+        generator = torch.Generator().manual_seed(seed)
+        order = torch.randperm(len(starts), generator=generator).tolist()
+
+        for chunk in order[worker_id::num_workers]:
+            start = starts[chunk]
+            end = min(start + chunk_size, num_imgs)
+            buffer = [self.dataset[i] for i in range(start, end)]
+            for i in torch.randperm(len(buffer)).tolist():
+                if buffer[i] is not None:
+                    yield buffer[i]
+
+class FaceScrubPairs(IterableDataset):
+    '''
+    Samples (baseline_image, comparison_image, label) pairs uniformly at random
+    from a "comparison" FaceScrubDataset, rather than shuffling all n ** 2 of
+    its indices. Each epoch yields steps_per_epoch pairs, split between the
+    DataLoader workers.
+
+    If positive_ratio is set, that fraction of the comparison images is drawn
+    from the same person as the baseline image.
+    '''
+    def __init__(self, dataset, **kwargs):
+        steps_per_epoch = kwargs.get("steps_per_epoch", len(dataset.img_paths))
+        positive_ratio = kwargs.get("positive_ratio", None)
+
+        if dataset.type != "comparison":
+            raise Exception("Invalid dataset type")
+
+        self.dataset = dataset
+        self.steps_per_epoch = steps_per_epoch
+        self.positive_ratio = positive_ratio
+        # a person's images are contiguous, starting at starts[label]
+        self._counts = np.bincount(dataset.labels, minlength=len(dataset.names))
+        self._starts = np.cumsum(self._counts) - self._counts
+
+    def __len__(self):
+        return self.steps_per_epoch
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+
+        num_steps = self.steps_per_epoch // num_workers
+        if worker_id < self.steps_per_epoch % num_workers:
+            num_steps += 1
+
+        num_imgs = len(self.dataset.img_paths)
+        labels = self.dataset.labels
+        for _ in range(num_steps):
+            x, y = torch.randint(num_imgs, (2,)).tolist()
+            if self.positive_ratio is not None and \
+                    torch.rand(()).item() < self.positive_ratio:
+                label = labels[x]
+                y = int(self._starts[label]) + \
+                    torch.randint(int(self._counts[label]), ()).item()
+            # same pair layout as FaceScrubDataset._get_pair_from_index()
+            yield self.dataset[x + y * num_imgs]
+
+def load_resized_img(path, img_size):
+    '''
+    Returns the image at path resized to a 3 x img_size x img_size uint8 array,
+    or None if the image can't be read.
+    '''
+    try:
+        img = Image.open(path)
+        # let libjpeg downscale while decoding, before the final resample
+        img.draft("RGB", (img_size, img_size))
+        img = img.convert("RGB").resize((img_size, img_size), Image.BILINEAR)
+    except Exception:
+        return None
+    return np.asarray(img).transpose(2, 0, 1)
+
+def prepare_batch(X, device, normalize=False):
+    '''
+    Moves a batch of uint8 images to device and converts it to floats in
+    [0, 1]. If normalize is set, the batch is normalized with MEAN and STD.
+    '''
+    X = X.to(device, non_blocking=True).float().div_(255)
+    if normalize:
+        mean = torch.tensor(MEAN, device=X.device).view(1, 3, 1, 1)
+        std = torch.tensor(STD, device=X.device).view(1, 3, 1, 1)
+        X = X.sub_(mean).div_(std)
+    return X
+
+def decode_batch(imgs, device, img_size=64):
+    '''
+    Decodes a list of raw JPEG tensors from a raw=True dataset on device, with
+    nvjpeg on CUDA devices, and resizes them into a uint8 batch of
+    3 x img_size x img_size images for prepare_batch().
+
+    Decoding a list in one call requires torchvision>=0.19.
+    '''
+    from torchvision.io import decode_jpeg, ImageReadMode
+    imgs = decode_jpeg(imgs, mode=ImageReadMode.RGB, device=device)
+    return torch.stack([tF.resize(img, [img_size, img_size], antialias=True)
+                        for img in imgs])
+
+def raw_collate(batch):
+    '''
+    Collate function for raw=True datasets. The JPEG bytes differ in length
+    and can't be stacked, so they are kept as lists for decode_batch(), and
+    the labels are collated as usual.
+    '''
+    batch = list(filter(lambda X: X is not None, batch))
+    columns = list(zip(*batch))
+    return [list(imgs) for imgs in columns[:-1]] + \
+        [default_collate(columns[-1])]
+
 def invalid_collate(batch):
     batch = list(filter(lambda X: X is not None, batch))
     return default_collate(batch)
 
+def make_loader(dataset, batch_size, shuffle=False, **kwargs):
+    '''
+    Returns a DataLoader over the dataset, set up for throughput. Batches are
+    staged in pinned memory so copies to the GPU can be asynchronous, each
+    worker prefetches prefetch_factor batches, and the workers persist between
+    epochs instead of being respawned. Any other kwargs are passed on to the
+    DataLoader, and override these defaults.
+
+    Persistent workers stay resident for the life of the loader, each holding
+    up to prefetch_factor pinned batches. Pass persistent_workers=False for
+    loaders that are only iterated once.
+    '''
+    params = {
+        "num_workers": max(1, multiprocessing.cpu_count()-2),
+        "collate_fn": invalid_collate,
+        "pin_memory": torch.cuda.is_available()
+    }
+    params.update(kwargs)
+    # both are only valid with worker processes
+    if params["num_workers"] > 0:
+        params.setdefault("persistent_workers", True)
+        params.setdefault("prefetch_factor", 4)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle,
+                      **params)
+
 def create_set(mode, num_imgs=5):
     '''
     This method randomly picks num_imgs images from the DATA_DIR folder and places them in a folder.
@@ -159,16 +576,23 @@ def create_set(mode, num_imgs=5):
     options = ["val", "test"]
     if mode not in options: return
     # path of all of the people names, "./name"
-    name_paths = list(map(lambda name: DATA_DIR + "/" + name, lsdir(DATA_DIR)))
+    name_paths = [DATA_DIR + "/" + name for name in lsdir(DATA_DIR)]
+    rng = np.random.default_rng()
     for path in name_paths:
         # "./name/val"
         test_path = path + "/" + mode
         mkdir(test_path)
-        file_names = list(filter(lambda i: i not in options, lsdir(path)))
+        # only files, which skips the val and test folders
+        with os.scandir(path) as entries:
+            file_names = [entry.name for entry in entries
+                          if entry.is_file() and entry.name[0] != "."]
         num_names = len(file_names)
-        idx = list(set(np.random.randint(0, num_names, num_names)))[:num_imgs]
+        idx = rng.choice(num_names, size=min(num_imgs, num_names),
+                         replace=False)
         for i in idx:
-            os.rename(path+"/"+file_names[i], test_path+"/"+file_names[i])
+            os.replace(path+"/"+file_names[i], test_path+"/"+file_names[i])
+    # the split changed, invalidate the dataset caches
+    os.utime(DATA_DIR)
 
 def undo_create_set(mode):
     '''
@@ -177,68 +601,77 @@ def undo_create_set(mode):
     options = ["val", "test"]
     if mode not in options: return
     # path of all of the people names
-    name_paths = list(map(lambda name: DATA_DIR + "/" + name,lsdir(DATA_DIR)))
+    name_paths = [DATA_DIR + "/" + name for name in lsdir(DATA_DIR)]
     for path in name_paths:
         test_path = path + "/" + mode
         if not os.path.exists(test_path):
             continue
-        test_imgs = lsdir(test_path)
-        for i in range(len(test_imgs)):
-            os.rename(test_path+"/"+test_imgs[i], path+"/"+test_imgs[i])
+        # collect the names first, moving entries mid-scan is unspecified
+        with os.scandir(test_path) as entries:
+            test_imgs = [entry.name for entry in entries
+                         if entry.is_file() and entry.name[0] != "."]
+        for img in test_imgs:
+            os.replace(test_path+"/"+img, path+"/"+img)
+    # the split changed, invalidate the dataset caches
+    os.utime(DATA_DIR)
 
 def assert_data_split_correct():
     undo_create_set("val")
     undo_create_set("test")
-    total_num = len(FaceScrubDataset(mode="train"))
-    num_people = len(FaceScrubDataset(mode="train").names)
-    assert total_num == 4083593409, "INCORRECT NUMBER OF IMAGES"
+    # the counts below are of comparison pairs, n ** 2 for n images
+    train = FaceScrubDataset(mode="train", type="comparison")
+    num_people = len(train.names)
+    assert len(train) == 4083593409, "INCORRECT NUMBER OF IMAGES"
     create_set("val")
     create_set("test")
-    train = len(FaceScrubDataset(mode="train"))
-    val = len(FaceScrubDataset(mode="val"))
-    test = len(FaceScrubDataset(mode="test"))
+    val = len(FaceScrubDataset(mode="val", type="comparison"))
+    test = len(FaceScrubDataset(mode="test", type="comparison"))
     assert val == (num_people * 5) ** 2
     assert test == (num_people * 5) ** 2
 
-def calc_mean(X):
-    array = np.asarray(X[0])
-    R = array[:,:,0].mean()
-    G = array[:,:,1].mean()
-    B = array[:,:,2].mean()
-    return R, G, B
-
-def calc_std(X):
-    array = np.asarray(X[0])
-    R = array[:,:,0].std()
-    G = array[:,:,1].std()
-    B = array[:,:,2].std()
-    return R, G, B
+def calc_stats(path):
+    '''
+    Returns the per-channel pixel sums, per-channel sums of squares and number
+    of pixels of the image at path.
+    '''
+    try:
+        array = np.asarray(Image.open(path).convert("RGB")).reshape(-1, 3)
+    except Exception:
+        return np.zeros(3, dtype=np.uint64), np.zeros(3, dtype=np.uint64), 0
+    sums = array.sum(axis=0, dtype=np.uint64)
+    squares = (array.astype(np.uint32) ** 2).sum(axis=0, dtype=np.uint64)
+    return sums, squares, len(array)
 
 def get_mean_std():
+    '''
+    Returns the per-channel mean and standard deviation of the pixels in the
+    dataset, scaled to [0, 1].
+    '''
     dataset = FaceScrubDataset(type="label")
-    pool = multiprocessing.Pool(max(1, multiprocessing.cpu_count()-2))
+    num_workers = max(1, multiprocessing.cpu_count()-2)
     print("Started calculating mean and stds")
-    means = pool.map(calc_mean, dataset)
-    stds = pool.map(calc_std, dataset)
-    pool.close()
-    pool.join()
-    return means, stds
+    # the pool's fork and IPC cost more than the work for small datasets
+    if len(dataset) < 10000 or num_workers == 1:
+        stats = list(map(calc_stats, dataset.img_paths))
+    else:
+        with multiprocessing.Pool(num_workers) as pool:
+            stats = list(pool.imap_unordered(calc_stats, dataset.img_paths,
+                                             chunksize=256))
+    sums, squares, num_pixels = (np.sum(stat, axis=0, dtype=np.uint64)
+                                 for stat in zip(*stats))
+    mean = sums / num_pixels
+    std = np.sqrt(squares / num_pixels - mean ** 2)
+    return mean / 255, std / 255
 
 if __name__ == "__main__":
     TRANSFORMS = [
         T.Resize((64, 64)),
-        T.ToTensor()
+        T.PILToTensor()
     ]
     dataset = FaceScrubDataset(transform=TRANSFORMS)
     print("Length: " + str(len(dataset)))
     #img = dataset[4000]
     # assert_data_split_correct()
 
-    # means, stds = get_mean_std()
-    # red_mean = 0.6118626050840847
-    # green_mean = 0.4627732225147951
-    # blue_mean = 0.39181750819165523
-    # red_std = 0.24004882860157573
-    # green_std = 0.20515205679125115
-    # blue_std = 0.19287499225344598
+    # mean, std = get_mean_std()
     pass
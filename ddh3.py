@@ -5,8 +5,8 @@ import torch.nn.functional as F
 import torchvision.transforms as T
 import multiprocessing
 from time import time
-from torch.utils.data import DataLoader
 from matplotlib import pyplot as plt
+from pdb import set_trace
 
 from dataset import *
 
@@ -160,7 +160,7 @@ LOADER_PARAMS = {
 
 TRANSFORMS = [
     T.Resize((CUSTOM_PARAMS['img_size'], CUSTOM_PARAMS['img_size'])),
-    T.ToTensor()
+    T.PILToTensor()
 ]
 
 data_train = FaceScrubDataset(type="label",
@@ -179,24 +179,26 @@ data_test = FaceScrubDataset(type="label",
                              hash_dim=HASH_DIM)
 
 # for training use, shuffling
-loader_train = DataLoader(data_train,
-                          batch_size=BATCH_SIZE["train"],
-                          shuffle=True,
-                          **LOADER_PARAMS)
+loader_train = make_loader(data_train,
+                           batch_size=BATCH_SIZE["train"],
+                           shuffle=True,
+                           **LOADER_PARAMS)
 
 # for use as gallery, no shuffling
-loader_gallery = DataLoader(data_train,
-                          batch_size=BATCH_SIZE["gallery"],
-                          shuffle=False,
-                          **LOADER_PARAMS)
-
-loader_val = DataLoader(data_val,
-                          batch_size=BATCH_SIZE["val"],
-                          shuffle=False,
-                          **LOADER_PARAMS)
-loader_test = DataLoader(data_test,
+loader_gallery = make_loader(data_train,
+                             batch_size=BATCH_SIZE["gallery"],
+                             shuffle=False,
+                             **LOADER_PARAMS)
+
+loader_val = make_loader(data_val,
+                         batch_size=BATCH_SIZE["val"],
+                         shuffle=False,
+                         **LOADER_PARAMS)
+loader_test = make_loader(data_test,
                           batch_size=BATCH_SIZE["test"],
                           shuffle=False,
+                          # only used once, at the end
+                          persistent_workers=False,
                           **LOADER_PARAMS)
 
 model_class = DDH3
@@ -224,8 +226,8 @@ def train(model, loader, optim, logger, **kwargs):
 
         half_size = BATCH_SIZE["train"] // 2
         half_size = len(X) // 2 if len(X) < half_size else half_size
-        X1 = X[:half_size].float().to(device=device)
-        X2 = X[half_size:].float().to(device=device)
+        X1 = prepare_batch(X[:half_size], device)
+        X2 = prepare_batch(X[half_size:], device)
         y1 = y[:half_size].long().to(device=device)
         y2 = y[half_size:].long().to(device=device)
         with torch.no_grad():
@@ -5,7 +5,6 @@ import torch.nn.functional as F
 import torchvision.transforms as T
 import multiprocessing
 from time import time
-from torch.utils.data import DataLoader
 from matplotlib import pyplot as plt
 
 from dataset import *
@@ -181,11 +180,11 @@ LOADER_PARAMS = {
 # create_set("test")
 TRANSFORMS = [
     T.Resize((CUSTOM_PARAMS['img_size'], CUSTOM_PARAMS['img_size'])),
-    T.ToTensor()
+    T.PILToTensor()
 ]
 
 DATASET_PARAMS = {
-    "align": True,
+    "use_align": True,
     "type": "label",
     "transform": TRANSFORMS,
     "hash_dim": HASH_DIM
@@ -201,24 +200,26 @@ data_test = FaceScrubDataset(mode="test",
                              **DATASET_PARAMS)
 
 # for training use, shuffling
-loader_train = DataLoader(data_train,
-                          batch_size=BATCH_SIZE["train"],
-                          shuffle=True,
-                          **LOADER_PARAMS)
+loader_train = make_loader(data_train,
+                           batch_size=BATCH_SIZE["train"],
+                           shuffle=True,
+                           **LOADER_PARAMS)
 
 # for use as gallery, no shuffling
-loader_gallery = DataLoader(data_train,
-                          batch_size=BATCH_SIZE["gallery"],
-                          shuffle=False,
-                          **LOADER_PARAMS)
-
-loader_val = DataLoader(data_val,
-                          batch_size=BATCH_SIZE["val"],
-                          shuffle=False,
-                          **LOADER_PARAMS)
-loader_test = DataLoader(data_test,
+loader_gallery = make_loader(data_train,
+                             batch_size=BATCH_SIZE["gallery"],
+                             shuffle=False,
+                             **LOADER_PARAMS)
+
+loader_val = make_loader(data_val,
+                         batch_size=BATCH_SIZE["val"],
+                         shuffle=False,
+                         **LOADER_PARAMS)
+loader_test = make_loader(data_test,
                           batch_size=BATCH_SIZE["test"],
                           shuffle=False,
+                          # only used once, at the end
+                          persistent_workers=False,
                           **LOADER_PARAMS)
 
 model_class = DDH4
@@ -241,7 +242,7 @@ def train(model, loader, optim, logger, **kwargs):
     for num_iter, (X, y) in enumerate(loader):
         optim.zero_grad()
 
-        X = X.to(device).float()
+        X = prepare_batch(X, device)
         y = y.to(device).long()
         codes, scores = model(X)
 
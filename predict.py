@@ -1,4 +1,5 @@
 import torch
+from dataset import prepare_batch
 
 
 def predict(model, loader_gallery, loader_test, logger, **kwargs):
@@ -18,7 +19,7 @@ def predict(model, loader_gallery, loader_test, logger, **kwargs):
         logger.write("Hashing {} gallery images..."
                         .format(len(loader_gallery.dataset)))
         for idx, (X, y) in enumerate(loader_gallery):
-            gcodes, _ = model(X.to(device=device))
+            gcodes, _ = model(prepare_batch(X, device))
 
             if data[0] is None:
                 data[0] = gcodes
@@ -40,7 +41,7 @@ def predict(model, loader_gallery, loader_test, logger, **kwargs):
         logger.write("Hashing test images and labels...")
         # process the test images
         for idx, (X, y) in enumerate(loader_test):
-            tcodes, _ = model(X.to(device=device))
+            tcodes, _ = model(prepare_batch(X, device))
 
             if data[2] is None:
                 data[2] = tcodes